@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 '''
 Generator - a Inkscape extension to generate end-use files from a model
@@ -38,15 +38,21 @@ Release notes:
                    convert to jpg from the command line.
                  * temporarily removed the gui functionalities provided by
                    zenity.
+    - version 0.6, 2026-09: ported to Python 3, so that the extension also
+                            runs unchanged on PyPy3 for a JIT speedup on
+                            the per-row substitution loops
 '''
 import os
 import tempfile
 import csv
 import re
 import shutil
-import StringIO
+import copy
+import subprocess
+import multiprocessing
+import mmap
+import hashlib
 from lxml import etree
-from xml.sax.saxutils import escape
 import inkex
 from inkex import errormsg
 from gettext import gettext as _
@@ -55,6 +61,14 @@ _use_rsvg = False
 
 
 class Generator(inkex.Effect):
+    _VAR_RE = re.compile(r'%VAR_([^%]+)%')
+    _IF_RE = re.compile(r'%IF_([^%]*)%')
+    _UNLESS_RE = re.compile(r'%UNLESS_([^%]*)%')
+    _LABEL_ATTR = inkex.addNS('label', ns='inkscape')
+    _SVG_G = inkex.addNS('g', ns='svg')
+    _LAYER_XP = etree.XPath('//svg:g[@inkscape:label]',
+                            namespaces=inkex.NSS)
+
     def __init__(self, *args, **kwargs):
         inkex.Effect.__init__(self, *args, **kwargs)
         self.OptionParser.add_option('--tab')
@@ -91,13 +105,29 @@ class Generator(inkex.Effect):
         self.header = None
         self.data = None
         self.tmpdir = tempfile.mkdtemp(prefix='ink-generator')
-        # svgouts is a dict {row_as_list: tmp_svg_output_file}
-        self.svgouts = {}
+        # svgouts is a list of (tmp_svg_file, outfile) pairs, one per row
+        self.svgouts = []
+        self._svgout_counter = 0
+        # _svg_by_hash maps the hash of a rendered svg to its tmp file, so
+        # that rows rendering to identical documents share one file.
+        self._svg_by_hash = {}
 
     def effect(self):
         """Do the work"""
         self.options.format = self.options.format.lower()
+        self._svg_tree = etree.parse(self.svg_file)
+        self._has_conditional_layers = any(
+            '%IF_' in g.attrib[self._LABEL_ATTR] or
+            '%UNLESS_' in g.attrib[self._LABEL_ATTR]
+            for g in self._LAYER_XP(self._svg_tree.getroot()))
         self.handle_csv()
+        self._extra_pairs = self.parse_extra_vars()
+        # A template without any '%' cannot contain variable tokens, so
+        # the whole per-row substitution walk can be skipped.  Extra-vars
+        # texts need not contain '%', hence their separate check.
+        with open(self.svg_file, 'rb') as f:
+            self._needs_substitution = (b'%' in f.read() or
+                                        bool(self._extra_pairs))
         if self.options.var_type == 'name':
             self.create_svg_name()
         else:
@@ -110,21 +140,30 @@ class Generator(inkex.Effect):
     def handle_csv(self):
         """Read data from the csv file and store the rows into self.data"""
         try:
-            reader = csv.reader(open(self.options.datafile, 'r'))
+            fh = open(self.options.datafile, 'rb')
         except IOError:
             errormsg(_('Cannot read "{}"'.format(self.options.datafile)))
             raise Exception(_('Cannot read "{}"'.format(self.options.datafile)))
-        if self.options.var_type == 'name':
+        with fh:
             try:
-                self.header = reader.next()
-            except StopIteration:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file cannot be mapped.
                 errormsg(_('Data file "{}" contains no data'.format(
                     self.options.datafile)))
                 raise Exception(_('Data file "{}" contains no data'.format(
                     self.options.datafile)))
-        self.data = []
-        for row in reader:
-            self.data.append(row)
+            reader = csv.reader(
+                line.decode('utf-8') for line in iter(mm.readline, b''))
+            if self.options.var_type == 'name':
+                self.header = next(reader)
+            self.data = list(reader)
+            mm.close()
+        if not self.data:
+            errormsg(_('Data file "{}" contains no data'.format(
+                self.options.datafile)))
+            raise Exception(_('Data file "{}" contains no data'.format(
+                self.options.datafile)))
 
     def create_svg_number(self):
         """Create a header, read each line and fill self.svgouts"""
@@ -133,38 +172,51 @@ class Generator(inkex.Effect):
 
     def create_svg_name(self):
         """Read each line and fill self.svgouts"""
+        self._build_substitutions()
         for l in self.data:
             d = self.get_line_desc(l)
-            self.svgouts[tuple(l)] = self.create_svg(d)
+            self.svgouts.append((self.create_svg(l, d), self.get_output(d)))
 
-    def create_svg(self, name_dict):
+    def create_svg(self, line, name_dict):
         """Writes out a modified svg"""
-        s = StringIO.StringIO()
-        for svg_line in open(self.svg_file, 'r').readlines():
-            # Modify the line to handle replacements from extension GUI
-            svg_line = self.expand_extra_vars(svg_line, name_dict)
-            # Modify the line to handle variables in svg file
-            svg_line = self.expand_vars(svg_line, name_dict)
-            s.write(svg_line)
-        # Modify the svg to include or exclude groups
-        root = etree.fromstring(s.getvalue())
-        self.filter_layers(root, name_dict)
+        root = copy.deepcopy(self._svg_tree.getroot())
+        # Expand variables and include or exclude groups in a single walk.
+        mapping = (self._make_mapping(line) if self._needs_substitution
+                   else None)
+        if mapping is not None or self._has_conditional_layers:
+            self._process_tree(root, name_dict, mapping)
+        xml_bytes = etree.tostring(root,
+                                   encoding='utf-8',
+                                   xml_declaration=True)
+        key = hashlib.sha1(xml_bytes).digest()
+        svgout = self._svg_by_hash.get(key)
+        if svgout is not None:
+            # Identical to an earlier row, reuse its file.
+            return svgout
         svgout = self.get_svgout()
+        # Write through a raw fd: the payload is a single bytes object,
+        # so the buffered file object would only add an extra copy.
         try:
-            f = open(svgout, 'w')
-            f.write(etree.tostring(root,
-                                   encoding='utf-8',
-                                   xml_declaration=True))
-        except IOError:
+            fd = os.open(svgout, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, xml_bytes)
+            finally:
+                os.close(fd)
+        except OSError:
             errormsg(_('Cannot open "' + svgout + '" for writing'))
-        finally:
-            f.close()
-        s.close()
+        else:
+            self._svg_by_hash[key] = svgout
         return svgout
 
     def get_svgout(self):
-        """Return the name of a temporary svg file"""
-        return tempfile.mktemp(dir=self.tmpdir, suffix='.svg')
+        """Return the name of a temporary svg file
+
+        The files live in the private tmpdir, so a simple counter is
+        enough to make the names unique; no tempfile uniqueness checks
+        are needed.
+        """
+        self._svgout_counter += 1
+        return os.path.join(self.tmpdir, '%08d.svg' % self._svgout_counter)
 
     def get_line_desc(self, line):
         """Return the current csv line as dict with csv headers as keys"""
@@ -174,153 +226,265 @@ class Generator(inkex.Effect):
         """Return the name of the output file for a csv entry"""
         return self.expand_vars(self.options.output, name_dict)
 
-    def expand_extra_vars(self, line, name_dict):
-        """Replace extra replacement values with the content from a csv entry"""
+    def _build_substitutions(self):
+        """Compile one pattern matching every variable token
+
+        The token set (%VAR_...% for each column plus the extra-vars
+        texts) is the same for every row, so the alternation is compiled
+        once.  Longer tokens come first so that overlapping extra-vars
+        texts are matched greedily.
+        """
+        tokens = ['%VAR_' + k + '%' for k in self.header]
+        tokens += [old_txt for old_txt, idx in self._extra_pairs]
+        tokens.sort(key=len, reverse=True)
+        self._subst_re = re.compile('|'.join(re.escape(t) for t in tokens))
+
+    def _make_mapping(self, line):
+        """Build the token -> replacement map for one csv row"""
+        mapping = {}
+        for k, v in zip(self.header, line):
+            mapping['%VAR_' + k + '%'] = v
+        for old_txt, idx in self._extra_pairs:
+            if idx < len(line):
+                mapping[old_txt] = line[idx]
+        return mapping
+
+    def _substitute(self, text, mapping):
+        """Replace every variable token in text in a single pass
+
+        Tokens whose column is missing from the row (short csv lines)
+        are left in place.
+        """
+        return self._subst_re.sub(
+            lambda m: mapping.get(m.group(0), m.group(0)), text)
+
+    def expand_element(self, elem, mapping):
+        """Expand the variables in an element's text, tail and attributes
+
+        The values are substituted unescaped; lxml escapes them as needed
+        at serialization time.
+        """
+        if elem.text:
+            elem.text = self._substitute(elem.text, mapping)
+        if elem.tail:
+            elem.tail = self._substitute(elem.tail, mapping)
+        for k, v in elem.attrib.items():
+            new_v = self._substitute(v, mapping)
+            if new_v != v:
+                elem.attrib[k] = new_v
+
+    def parse_extra_vars(self):
+        """Parse the extra-vars option once into (old_txt, column index) pairs
+
+        Storing the column index lets the per-row code take the value
+        straight from the row list instead of a name lookup.
+        """
+        pairs = []
         if not self.options.extra_vars:
-            return line
-        replacement_strings = self.options.extra_vars.split('|')
-        for t in replacement_strings:
+            return pairs
+        for t in self.options.extra_vars.split('|'):
             try:
                 old_txt, column = t.split('=>')
             except ValueError:
                 errormsg(_('Unrecognized replacement string {}'.format(t)))
                 raise Exception(_('Unrecognized replacement string {}'.format(
                     t)))
-            if line.find(old_txt) < 0:
-                # Nothing to be replaced.
-                continue
-            try:
-                new_txt = escape(name_dict[column])
-            except KeyError:
-                if self.options.var_type == 'name':
+            if self.options.var_type == 'name':
+                if column not in self.header:
                     errormsg(_('Wrong column name "{}"'.format(column)))
                     raise Exception(_('Wrong column name "{}"'.format(column)))
-                else:
+                idx = self.header.index(column)
+            else:
+                if (not column.isdigit() or
+                        (self.data and int(column) >= len(self.data[0]))):
                     errormsg(_('Wrong column number ({})'.format(column)))
                     raise Exception(_('Wrong column number ({})'.format(
                         column)))
-            line = line.replace(old_txt, new_txt)
-        return line
+                idx = int(column)
+            pairs.append((old_txt, idx))
+        return pairs
 
     def expand_vars(self, line, name_dict):
         """Replace %VAR_???% with the content from a csv entry"""
         if '%' not in line:
             return line
-        for k, v in name_dict.iteritems():
-            line = line.replace('%VAR_' + k + '%', escape(v))
-        return line
-
-    def filter_layers(self, root, name_dict):
-        """Return the xml root with filtered layers"""
-        for g in root.xpath("//svg:g", namespaces=inkex.NSS):
-            attr = inkex.addNS('label', ns='inkscape')
-            if attr not in g.attrib:
-                # Not a layer, skip.
-                continue
-            label = g.attrib[attr]
-            if '%' not in label:
-                # Nothing to be done, skip.
-                continue
-
-            # Treat %IF_???% layers
-            match = re.match('.*%IF_([^%]*)%', label)
-            if match is not None:
-                lookup = match.groups()[0]
-                try:
-                    var = name_dict[lookup]
-                except KeyError:
-                    errormsg(_('Column "' + lookup + '" not in the csv file'))
-                    continue
-                if var and (var.lower() not in ('0', 'false', 'no')):
-                    # Set group visibility to true.
-                    if 'style' in g.attrib:
-                        del g.attrib['style']
-                    # Include the group.
-                    continue
-                else:
-                    # Remove the group's content.
-                    g.clear()
-
-            # Treat %UNLESS_???% layers
-            match = re.match('.*%UNLESS_([^%]*)%', label)
-            if match is not None:
-                lookup = match.groups()[0]
-                try:
-                    var = name_dict[lookup]
-                except KeyError:
-                    errormsg(_('Column "' + lookup + '" not in the csv file'))
-                    continue
-                if not(var) or (var.lower() in ('0', 'false', 'no')):
-                    # Set group visibility to true.
-                    if 'style' in g.attrib:
-                        del g.attrib['style']
-                    # Include the group.
-                    continue
-                else:
-                    # Remove the group's content.
-                    g.clear()
+        return self._VAR_RE.sub(
+            lambda m: name_dict.get(m.group(1), m.group(0)), line)
+
+    def _process_tree(self, root, name_dict, mapping):
+        """Expand variables and filter conditional layers in one walk
+
+        The element list is materialized first because clearing a group
+        detaches its descendants while they are being iterated.
+        """
+        filter_groups = self._has_conditional_layers
+        for elem in list(root.iter()):
+            if mapping is not None:
+                self.expand_element(elem, mapping)
+            if filter_groups and elem.tag == self._SVG_G:
+                label = elem.attrib.get(self._LABEL_ATTR)
+                if label is not None and '%' in label:
+                    self.filter_layer(elem, label, name_dict)
+
+    def filter_layer(self, g, label, name_dict):
+        """Include or exclude one labeled group based on its %IF_/%UNLESS_"""
+        # Treat %IF_???% layers
+        match = self._IF_RE.search(label)
+        if match is not None:
+            lookup = match.groups()[0]
+            try:
+                var = name_dict[lookup]
+            except KeyError:
+                errormsg(_('Column "' + lookup + '" not in the csv file'))
+                return
+            if var and (var.lower() not in ('0', 'false', 'no')):
+                # Set group visibility to true.
+                g.attrib.pop('style', None)
+                # Include the group.
+                return
+            else:
+                # Remove the group's content.
+                g.clear()
+
+        # Treat %UNLESS_???% layers
+        match = self._UNLESS_RE.search(label)
+        if match is not None:
+            lookup = match.groups()[0]
+            try:
+                var = name_dict[lookup]
+            except KeyError:
+                errormsg(_('Column "' + lookup + '" not in the csv file'))
+                return
+            if not(var) or (var.lower() in ('0', 'false', 'no')):
+                # Set group visibility to true.
+                g.attrib.pop('style', None)
+                # Include the group.
+                return
+            else:
+                # Remove the group's content.
+                g.clear()
 
     def export(self):
         """Writes out all output files"""
-        def get_export_cmd(svgfile, fmt, dpi, outfile):
-            if _use_rsvg and os.name == 'posix':
-                # Deactivated for now because rsvg-convert (v 2.36.4) changes
-                # the size in output pdf files for some svg files. It's a pity,
-                # rsvg-convert is much faster.
-                ret = os.system('rsvg-convert --version 1>/dev/null')
-                if ret == 0:
-                    return ('rsvg-convert' +
-                            ' --dpi-x=' + dpi +
-                            ' --dpi-y=' + dpi +
-                            ' --format=' + fmt +
-                            ' --output="' + outfile + '"' +
-                            ' "' + svgfile + '"')
-            else:
-                return ('inkscape --without-gui ' +
-                        '--export-dpi=' + dpi + ' ' +
-                        '--export-' + fmt + '="' + outfile + '" '
-                        '"' + svgfile + '"')
-
-        for line, svgfile in self.svgouts.iteritems():
-            d = self.get_line_desc(line)
-            outfile = self.get_output(d)
-            if self.options.format == 'jpg':
-                # TODO: output a jpg file
-                self.options.format = 'png'
+        was_jpg = self.options.format == 'jpg'
+        if was_jpg:
+            # TODO: output a jpg file
+            self.options.format = 'png'
+        fmt = self.options.format
+        dpi = self.options.dpi
+        # Deactivated for now because rsvg-convert (v 2.36.4) changes
+        # the size in output pdf files for some svg files. It's a pity,
+        # rsvg-convert is much faster.
+        rsvg = _use_rsvg and os.name == 'posix' and self.have_rsvg()
+        # Rows sharing a deduplicated svg file are converted only once;
+        # the remaining outputs are plain copies of the first one.
+        outfiles = {}  # svgfile -> [outfile, ...]
+        for svgfile, outfile in self.svgouts:
+            if was_jpg:
                 outfile = outfile.replace('jpg', 'png')
-            if self.options.format == 'svg':
+            outfiles.setdefault(svgfile, []).append(outfile)
+        export_lines = []
+        copies = []
+        for svgfile, outs in outfiles.items():
+            outfile = outs[0]
+            if fmt == 'svg':
                 try:
                     shutil.move(svgfile, outfile)
                 except OSError:
                     errormsg(_('Cannot create "' + outfile + '"'))
+            elif rsvg:
+                subprocess.call(['rsvg-convert',
+                                 '--dpi-x=' + dpi,
+                                 '--dpi-y=' + dpi,
+                                 '--format=' + fmt,
+                                 '--output=' + outfile,
+                                 svgfile])
             else:
-                cmd = get_export_cmd(svgfile,
-                                     self.options.format,
-                                     self.options.dpi, outfile)
-                os.system(cmd)
+                # Quote both paths (as the old os.system command did) so
+                # that inkscape's shell-line parser keeps file names with
+                # whitespace in one piece.
+                export_lines.append('"' + svgfile + '"' +
+                                    ' --export-dpi=' + dpi +
+                                    ' --export-' + fmt +
+                                    '="' + outfile + '"')
+            copies.extend((outfile, dup) for dup in outs[1:]
+                          if dup != outfile)
+        if export_lines:
+            self.run_export_shells(export_lines)
+        for src, dst in copies:
+            try:
+                shutil.copy(src, dst)
+            except (IOError, OSError):
+                errormsg(_('Cannot create "' + dst + '"'))
+
+    @staticmethod
+    def have_rsvg():
+        """Return whether rsvg-convert is available"""
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return subprocess.call(['rsvg-convert', '--version'],
+                                       stdout=devnull) == 0
+        except OSError:
+            return False
+
+    def run_export_shells(self, export_lines):
+        """Convert the svg files with a pool of inkscape --shell workers
+
+        Each worker converts its share of the rows, so that the process
+        startup time is paid only once per core instead of once per row
+        and the conversions themselves run in parallel.
+        """
+        nworkers = min(multiprocessing.cpu_count(), len(export_lines))
+        workers = []
+        with open(os.devnull, 'w') as devnull:
+            # Not '_' for the throwaway variable, it would shadow gettext.
+            for _i in range(nworkers):
+                try:
+                    workers.append(subprocess.Popen(['inkscape', '--shell',
+                                                     '--without-gui'],
+                                                    stdin=subprocess.PIPE,
+                                                    stdout=devnull,
+                                                    universal_newlines=True))
+                except OSError:
+                    break
+            if not workers:
+                errormsg(_('Cannot run inkscape'))
+                return
+            for i, export_line in enumerate(export_lines):
+                try:
+                    workers[i % len(workers)].stdin.write(export_line + '\n')
+                except OSError:
+                    # The worker died early; reported below via its
+                    # exit status.
+                    pass
+            for w in workers:
+                try:
+                    w.stdin.write('quit\n')
+                    w.stdin.close()
+                except OSError:
+                    pass
+            for w in workers:
+                if w.wait() != 0:
+                    errormsg(_('inkscape export exited with status {}'.format(
+                        w.returncode)))
 
     def show_preview(self):
         systems = {
             'nt': os.startfile if 'startfile' in dir(os) else None,
-            'posix': lambda fname: os.system(
-                'xdg-open "{0}"'.format(fname)),
-            'os2': lambda fname: os.system(
-                'open "{0}"'.format(fname)),
+            'posix': lambda fname: subprocess.call(['xdg-open', fname]),
+            'os2': lambda fname: subprocess.call(['open', fname]),
         }
         try:
-            line = self.svgouts.keys()[0]
-            d = self.get_line_desc(line)
-            outfile = self.get_output(d)
+            svgfile, outfile = self.svgouts[0]
             systems[os.name](outfile)
         except:
             errormsg(_('Error open preview file'))
 
     def clean(self):
         """Delete temporary svg files and directory"""
-        if self.options.format != 'svg':
-            for svgfile in self.svgouts.itervalues():
-                os.remove(svgfile)
-        os.rmdir(self.tmpdir)
+        # Files exported as svg were already moved out of tmpdir, so a
+        # single recursive removal covers every format.
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
 
 if __name__ == '__main__':
     e = Generator()